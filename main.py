@@ -12,6 +12,11 @@ if __name__ == "__main__":
     parser.add_argument("--source", type=str, required=True, help="Path to the LaTeX source file to translate.")
     parser.add_argument("--chunk_size", type=int, default=3000, help="Size of each LaTeX chunk to translate.")
     parser.add_argument("--output", type=str, default='translated.txt', help="Path to save the translated text.")
+    parser.add_argument("--concurrency", type=int, default=8, help="Number of chunks to translate in parallel (1 = sequential).")
+    parser.add_argument("--mode", type=str, default="interactive", choices=["interactive", "batch"], help="'batch' submits the whole paper to the Gemini Batch API (50%% cheaper, minutes-hours latency).")
+    parser.add_argument("--group_size", type=int, default=1, help="Pack this many chunks into each request (1 = one chunk per request).")
+    parser.add_argument("--target_tokens", type=int, default=None, help="Size chunks by token budget instead of --chunk_size characters (uses count_tokens once).")
+    parser.add_argument("--service_tier", type=str, default="flex", choices=["flex", "standard", "priority"], help="Gemini service tier; 'flex' is 50%% cheaper and fine for offline paper translation.")
 
 
     args = parser.parse_args()
@@ -21,8 +26,13 @@ if __name__ == "__main__":
     translator = LaTeXTranslator(
         client, 
         model=args.model,
-        chunk_size=args.chunk_size, 
-        save_path=args.output)
+        chunk_size=args.chunk_size,
+        save_path=args.output,
+        concurrency=args.concurrency,
+        mode=args.mode,
+        group_size=args.group_size,
+        target_tokens=args.target_tokens,
+        service_tier=args.service_tier)
 
     source = open(args.source, 'r', encoding='utf-8').read()
     translator.translate(source)
\ No newline at end of file
@@ -1,40 +1,48 @@
+import array
 import re
 from typing import List, Tuple
 
+# 正文可合并的环境（热循环内 O(1) 集合查找）
+_MERGE_ENVS = frozenset(('document', 'abstract'))
+# 命令名后的空白跳过（C 级匹配，替代逐字符 isspace 循环）
+_WS_RE = re.compile(r'\s*')
+
 def remove_useless_newlines(tex: str) -> str:
     # ===== 合并规则（逐行、只看行首）=====
     INLINE = ('\\eg', '\\footnote', '\\cite', '\\citet', '\\citep', '\\cref', '\\Cref', '\\ie')
 
-    def is_blank_line(ln: str) -> bool:
-        return ln.lstrip().rstrip('\r\n') == ''
-
-    def is_text_line(ln: str) -> bool:
-        s = ln.lstrip().rstrip('\r\n')
+    def is_text_line(s: str) -> bool:
+        """s 为已去除首尾空白的行内容"""
         if s == '':
             return False
         if s.startswith('$'):
             return True
         if s.startswith('\\'):
-            return any(s.startswith(cmd) for cmd in INLINE)
+            # startswith 接受 tuple，在 C 层一次完成全部前缀比较
+            return s.startswith(INLINE)
         return True
 
     def merge_lines_block(block: str) -> str:
+        # 单行片段（caption 短文本等）没有可合并的行，直接原样返回
+        if '\n' not in block:
+            return block
         lines = block.splitlines(keepends=True)
         out, can_merge = [], False
         for ln in lines:
-            if is_blank_line(ln):
+            s = ln.lstrip().rstrip('\r\n')   # 每行只 strip 一次，空行/文本行判断共用
+            if s == '':
                 out.append(ln); can_merge = False; continue
-            if can_merge and is_text_line(ln):
+            is_text = is_text_line(s)
+            if can_merge and is_text:
                 out[-1] = out[-1].rstrip() + ' ' + ln.lstrip()
             else:
-                out.append(ln); can_merge = is_text_line(ln)
+                out.append(ln); can_merge = is_text
         return ''.join(out)
 
     # ===== 小工具 =====
     n = len(tex)
     def skip_ws(i: int) -> int:
-        while i < n and tex[i].isspace(): i += 1
-        return i
+        return _WS_RE.match(tex, i).end()
 
     def parse_group(i: int, open_ch='{', close_ch='}') -> Tuple[int, int, int]:
         """给定 tex[i] 是 '{' 或 '['，返回 (content_start, content_end, next_index)。"""
@@ -57,7 +65,10 @@ def remove_useless_newlines(tex: str) -> str:
 
     # ===== 一次扫描：环境栈 + 收集待处理片段 =====
     env_stack: List[str] = []              # 小写环境名
-    segments: List[Tuple[int, int]] = []   # 半开区间 [s, e)
+    in_merge = False                       # 缓存“栈顶 ∈ _MERGE_ENVS”，随压栈/弹栈同步更新
+    # 半开区间 [s, e)，拆成两列扁平 array 存储（SoA），避免逐段分配 tuple
+    seg_start = array.array('q')
+    seg_end = array.array('q')
     open_seg: int | None = None            # 当前“可合并”的片段起点（当栈顶 ∈ {document, abstract} 时）
 
     i = 0
@@ -76,13 +87,14 @@ def remove_useless_newlines(tex: str) -> str:
                     env = tex[cs:ce].strip().lower()
 
                     # 进入任何环境前，若当前栈顶是 document（顶层正文片段），先截断
-                    if env_stack and env_stack[-1] in ('document', 'abstract') and open_seg is not None:
-                        segments.append((open_seg, i)); open_seg = None
+                    if in_merge and open_seg is not None:
+                        seg_start.append(open_seg); seg_end.append(i); open_seg = None
 
                     env_stack.append(env)
+                    in_merge = env in _MERGE_ENVS
 
                     # 进入 document / abstract 后，从 \begin{...} 的右花括号后一位开始新的片段
-                    if env in ('document', 'abstract'):
+                    if env in _MERGE_ENVS:
                         open_seg = j_after
 
                     i = j_after
@@ -96,17 +108,18 @@ def remove_useless_newlines(tex: str) -> str:
                     env = tex[cs:ce].strip().lower()
 
                     # 结束 env 之前，若当前栈顶就是它，且它是可合并环境，则把片段截到 \end 的反斜杠处
-                    if env_stack and env_stack[-1] == env and env in ('document', 'abstract') and open_seg is not None:
-                        segments.append((open_seg, i)); open_seg = None
+                    if in_merge and env_stack[-1] == env and open_seg is not None:
+                        seg_start.append(open_seg); seg_end.append(i); open_seg = None
 
-                    # 宽容弹栈
+                    # 宽容弹栈（每个元素至多弹一次，整体摊还 O(n)）
                     while env_stack and env_stack[-1] != env:
                         env_stack.pop()
                     if env_stack:
                         env_stack.pop()
+                    in_merge = bool(env_stack) and env_stack[-1] in _MERGE_ENVS
 
                     # 退出某环境后，若新的栈顶是 document/abstract，则从 \end{...} 的右花括号后一位继续开片段
-                    if env_stack and env_stack[-1] in ('document', 'abstract') and open_seg is None:
+                    if in_merge and open_seg is None:
                         open_seg = j_after
 
                     i = j_after
@@ -126,37 +139,39 @@ def remove_useless_newlines(tex: str) -> str:
                     cs, ce, k_after = parse_group(k, '{', '}')
                     # 若有打开的顶层片段，先截断到 caption 内容开始
                     if open_seg is not None and open_seg < cs:
-                        segments.append((open_seg, cs))
+                        seg_start.append(open_seg); seg_end.append(cs)
                         open_seg = None
                     # 记录 caption 正文参数
                     if cs < ce:
-                        segments.append((cs, ce))
+                        seg_start.append(cs); seg_end.append(ce)
                     # caption 结束后，如栈顶是 document/abstract，则从 '}' 后继续开片段
-                    if env_stack and env_stack[-1] in ('document', 'abstract'):
+                    if in_merge:
                         open_seg = k_after
                     i = k_after
                     continue
 
             # 其它命令：如果当前栈顶是 document/abstract 且还没开片段，则从这里开
-            if env_stack and env_stack[-1] in ('document', 'abstract') and open_seg is None:
+            if in_merge and open_seg is None:
                 open_seg = i
             i = j if j > i else i + 1
         else:
             # 普通字符：处于 document/abstract 时确保片段开启
-            if env_stack and env_stack[-1] in ('document', 'abstract') and open_seg is None:
+            if in_merge and open_seg is None:
                 open_seg = i
-            i += 1
+            # 用 C 级 find 直接跳到下一个 '\'，整段纯文本不再逐字符推进
+            nxt = tex.find('\\', i + 1)
+            i = nxt if nxt != -1 else n
 
     # 文件结束：若仍有打开片段
     if open_seg is not None and open_seg < n:
-        segments.append((open_seg, n))
+        seg_start.append(open_seg); seg_end.append(n)
 
-    if not segments:
+    if not seg_start:
         return tex
 
     # ===== 把这些片段做“按行合并”，再拼回去 =====
     out, last = [], 0
-    for s, e in segments:
+    for s, e in zip(seg_start, seg_end):
         if last < s:
             out.append(tex[last:s])
         out.append(merge_lines_block(tex[s:e]))
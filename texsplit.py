@@ -1,205 +1,217 @@
 from __future__ import annotations
-from typing import Any, Dict, List, Tuple, Optional
+from typing import Any, Dict, Iterator, List, Tuple, Optional
+import bisect
+import functools
 import re
+import statistics
+from concurrent.futures import ProcessPoolExecutor
 from merge_line import remove_useless_newlines
 
-from pylatexenc.latexwalker import (
-    LatexWalker,
-    LatexNode,
-    LatexEnvironmentNode,
-    LatexCharsNode,
-    LatexCommentNode,
-    LatexMacroNode,
-)
-
 BLANKLINE_RE = re.compile(r'(?:\r?\n[ \t]*){2,}', re.MULTILINE)
+# 连续 ≥3 个换行（允许夹杂空白）→ 压缩为一个空行
+_MULTI_BLANK_RE = re.compile(r'(?:[ \t]*(?:\r?\n)){3,}')
+# 切点扫描器：环境边界、\par、转义序列、花括号、顶层空行，一遍扫完
+_CUT_TOKEN_RE = re.compile(
+    r'\\begin\{([^}]*)\}'
+    r'|\\end\{([^}]*)\}'
+    r'|\\par\b'
+    r'|\\.'
+    r'|([{}])'
+    r'|' + BLANKLINE_RE.pattern
+)
+# 正文边界定位用的字面量（固定串用 str.find 即可，无需正则）
+_BEGIN_DOC = '\\begin{document}'
+_END_DOC = '\\end{document}'
+# verbatim 类环境整段掩码，里面的 '%' 不是注释
+_VERBATIM_RE = re.compile(
+    r'\\begin\{(verbatim|lstlisting|minted)\*?\}.*?\\end\{\1\*?\}', re.S)
 
 
 class LaTeXSlicingError(Exception):
     pass
 
 
-def _walk_nodes(nodes: List[LatexNode]):
-    """遍历节点树（尽量复用 latexwalker 通用结构，不造轮子）。"""
-    stack = list(nodes)[::-1]
-    while stack:
-        nd = stack.pop()
-        yield nd
-
-        nl = getattr(nd, "nodelist", None)
-        if isinstance(nl, list):
-            stack.extend(nl[::-1])
-
-        nodeargd = getattr(nd, "nodeargd", None)
-        if nodeargd is not None:
-            arglist = getattr(nodeargd, "arglist", None) or getattr(nodeargd, "argnlist", None)
-            if arglist:
-                for arg in reversed(arglist):
-                    if hasattr(arg, "nodelist") and isinstance(arg.nodelist, list):
-                        stack.extend(arg.nodelist[::-1])
-                    elif hasattr(arg, "node") and isinstance(arg.node, LatexNode):
-                        stack.append(arg.node)
+def _comment_start(line: str) -> int:
+    """单遍前向扫描：返回行内第一个未被转义的 '%' 下标，没有则 -1。
+    连续反斜杠按奇偶性判断（\\% 里的 % 是注释，\% 不是）。"""
+    escaped = False
+    for i, ch in enumerate(line):
+        if ch == '\\':
+            escaped = not escaped
+        elif ch == '%' and not escaped:
+            return i
+        else:
+            escaped = False
+    return -1
 
 
-def _find_first_env(nodes: List[LatexNode], name: str) -> Optional[LatexEnvironmentNode]:
-    for nd in _walk_nodes(nodes):
-        if isinstance(nd, LatexEnvironmentNode) and nd.envname == name:
-            return nd
-    return None
+def _strip_comments_lines(region: str, parts: List[str], at_eof: bool) -> None:
+    """逐行去掉 region 里的注释，结果追加到 parts。"""
+    for line in region.splitlines(keepends=True):
+        if '%' not in line:
+            parts.append(line)
+            continue
+        idx = _comment_start(line)
+        if idx == -1:
+            parts.append(line)
+        elif line[:idx].strip():
+            # 行尾注释：砍掉注释，保留代码与换行（及下一行缩进，原地未动）
+            if line.endswith('\r\n'):
+                eol = '\r\n'
+            elif line.endswith(('\n', '\r')):
+                eol = line[-1]
+            else:
+                # 文件末尾的行尾注释：补一个换行，避免把两行粘在一起
+                eol = '\n' if at_eof else ''
+            parts.append(line[:idx] + eol)
+        else:
+            # 整行注释：连同换行一起删除（不留下空白行），行首空白原样保留
+            parts.append(line[:idx])
 
 
 def _remove_comments(tex: str) -> str:
     """
     去除注释，并保持：
-      - 行尾注释（代码后面的 % ...）删除后，仍保留该行的换行与（若存在于注释节点内的）下一行缩进；
+      - 行尾注释（代码后面的 % ...）删除后，仍保留该行的换行与下一行缩进；
       - 仅由“整行注释”（行首仅空白后直接 %）分隔的两段文字，删除后不留下任何空行（不会出现多一个空白行）；
       - 多个连续空白行压缩为一个空行（最多两个换行符）。
-    依赖 pylatexenc 的 LatexCommentNode，避免误伤 verbatim 等环境。
+    单遍逐行扫描（反斜杠奇偶性判转义），verbatim/lstlisting/minted 整段掩码，
+    不再为找注释构建完整语法树。
     """
-    import re
-    from pylatexenc.latexwalker import LatexWalker, LatexCommentNode
-
-    walker = LatexWalker(tex)
-    nodelist, _, _ = walker.get_latex_nodes()
+    # 快速路径：整篇没有 '%' 时只做空行压缩
+    if '%' not in tex:
+        return _MULTI_BLANK_RE.sub('\n\n', tex)
 
-    # 收集注释区间
-    spans = []
-    for nd in _walk_nodes(nodelist):
-        if isinstance(nd, LatexCommentNode):
-            spans.append((nd.pos, nd.pos + nd.len))
-    spans.sort()
-
-    parts = []
+    parts: List[str] = []
     cur = 0
     n = len(tex)
+    for m in _VERBATIM_RE.finditer(tex):
+        _strip_comments_lines(tex[cur:m.start()], parts, at_eof=False)
+        parts.append(m.group(0))
+        cur = m.end()
+    _strip_comments_lines(tex[cur:n], parts, at_eof=True)
 
-    for s, e in spans:
-        if s < cur:
-            # 重叠/嵌套的健壮性处理
-            continue
-
-        # 追加注释前的原文
-        parts.append(tex[cur:s])
-
-        ctext = tex[s:e]
-
-        # 判断是否“整行注释”：从本行行首到 '%' 之间只有空白
-        # 找到本行起点
-        prev_nl = tex.rfind('\n', 0, s)
-        prev_cr = tex.rfind('\r', 0, s)
-        line_start = max(prev_nl, prev_cr) + 1 if max(prev_nl, prev_cr) != -1 else 0
-        line_prefix = tex[line_start:s]
-        full_line_comment = re.fullmatch(r'[ \t]*', line_prefix) is not None
-
-        # 检测注释文本中是否包含换行（以及提取“最后一个”换行的具体序列）
-        last_eol_idx = -1
-        last_eol_len = 0
-        idx = ctext.rfind("\r\n")
-        if idx != -1:
-            last_eol_idx, last_eol_len = idx, 2
-        else:
-            idx = ctext.rfind("\n")
-            if idx != -1:
-                last_eol_idx, last_eol_len = idx, 1
-            else:
-                idx = ctext.rfind("\r")
-                if idx != -1:
-                    last_eol_idx, last_eol_len = idx, 1
-
-        if last_eol_idx != -1:
-            # 注释节点内自带换行
-            if not full_line_comment:
-                # 行尾注释：保留该换行，并在注释节点内提取紧随其后的缩进（若存在）
-                parts.append(ctext[last_eol_idx:last_eol_idx + last_eol_len])
-                indent = re.match(r"[ \t]*", ctext[last_eol_idx + last_eol_len:]).group(0)
-                parts.append(indent)
-            else:
-                # 整行注释：完全删除该行（不补任何换行），从而不会留下空白行
-                pass
-        else:
-            # 注释节点不含换行（例如文件末尾的行尾注释）
-            if not full_line_comment:
-                # 行尾注释：若后面没有现成的换行，就补一个换行，避免把两行粘在一起
-                if not (e < n and tex[e] in "\r\n"):
-                    parts.append("\n")
-            else:
-                # 整行注释（且注释本身无换行，通常发生在文件末尾）：不补换行
-                pass
-
-        cur = e
-
-    parts.append(tex[cur:])
     out = "".join(parts)
 
-    # 合并多余空行：把连续 ≥3 个换行（允许夹杂空白）压缩为恰好两个换行（一个空行）
-    out = re.sub(r'(?:[ \t]*(?:\r?\n)){3,}', '\n\n', out)
+    # 合并多余空行：压缩为恰好两个换行（一个空行）
+    return _MULTI_BLANK_RE.sub('\n\n', out)
 
-    return out
 
+def _document_body_bounds(tex: str) -> Tuple[int, int]:
+    """定位正文区间：\\begin{document} 之后到 \\end{document} 之前；
+    没有 document 环境则整篇视为正文。纯字符串定位，无需解析。"""
+    b = tex.find(_BEGIN_DOC)
+    if b == -1:
+        return 0, len(tex)
 
-def _document_body_bounds(tex: str, nodelist: List[LatexNode]) -> Tuple[int, int, Optional[LatexEnvironmentNode]]:
-    doc_env = _find_first_env(nodelist, "document")
-    if doc_env is None:
-        return 0, len(tex), None
+    body_start = b + len(_BEGIN_DOC)
+    e = tex.find(_END_DOC, body_start)
+    if e == -1:
+        return body_start, len(tex)
+    return body_start, e
 
-    env_slice = tex[doc_env.pos: doc_env.pos + doc_env.len]
-    m_begin = re.search(r'\\begin\{document\}', env_slice)
-    m_end = re.search(r'\\end\{document\}', env_slice)
-    if not (m_begin and m_end):
-        if doc_env.nodelist:
-            s = doc_env.nodelist[0].pos
-            e = doc_env.nodelist[-1].pos + doc_env.nodelist[-1].len
-            return s, e, doc_env
-        return doc_env.pos, doc_env.pos, doc_env
 
-    body_start = doc_env.pos + m_begin.end()
-    body_end = doc_env.pos + m_end.start()
-    return body_start, body_end, doc_env
-
-
-def _allowed_cut_positions(tex: str, body_start: int, body_end: int,
-                           body_top_nodes: List[LatexNode]) -> List[int]:
+def _allowed_cut_positions(tex: str, body_start: int, body_end: int) -> List[int]:
     """
     允许切分的位置（严格避免行内处切分）：
-      - 顶层环境的开始/结束（LatexEnvironmentNode）
-      - 顶层 LatexCharsNode 里的“空行末端”（≥2 个换行，可夹空白）
-      - 顶层 \par 宏之后（LatexMacroNode(macroname=='par') 的 end）
+      - 顶层环境的开始/结束（\\begin{...} 前、对应 \\end{...} 后）
+      - 顶层空行末端（≥2 个换行，可夹空白）
+      - 顶层 \\par 之后
+    单遍正则扫描 + 环境/花括号深度计数，无需构建语法树；
+    深度 >0 的一切位置（环境内部、宏参数内部）都视为行内，不加入边界。
+    扫描按位置顺序产出切点，直接有序追加即可，免去集合去重 + 末尾排序。
     """
-    allowed = {body_start, body_end}
-
-    for nd in body_top_nodes:
-        s = max(nd.pos, body_start)
-        e = min(nd.pos + nd.len, body_end)
-        if not (s < e):
-            continue
+    cuts: List[int] = [body_start]
+    env_depth = 0
+    brace_depth = 0
+
+    def add(p: int) -> None:
+        # 相邻 token 可能给出同一位置（如 \end 之后紧跟 \begin），只需查尾去重
+        if p != cuts[-1]:
+            cuts.append(p)
+
+    for m in _CUT_TOKEN_RE.finditer(tex, body_start, body_end):
+        if m.group(1) is not None:
+            # \begin{...}
+            if env_depth == 0 and brace_depth == 0:
+                add(m.start())
+            env_depth += 1
+        elif m.group(2) is not None:
+            # \end{...}（宽容处理多余的 \end）
+            if env_depth > 0:
+                env_depth -= 1
+            if env_depth == 0 and brace_depth == 0:
+                add(m.end())
+        elif m.group(3) is not None:
+            if m.group(3) == '{':
+                brace_depth += 1
+            elif brace_depth > 0:
+                brace_depth -= 1
+        elif m.group(0).startswith('\\par'):
+            if env_depth == 0 and brace_depth == 0:
+                add(m.end())
+        elif m.group(0)[0] == '\\':
+            # 其它转义序列（\{、\%、\\ 等）：仅消费，防止误读其后字符
+            pass
+        else:
+            # 空行
+            if env_depth == 0 and brace_depth == 0:
+                add(m.end())
 
-        if isinstance(nd, LatexEnvironmentNode):
-            allowed.add(s)
-            allowed.add(e)
-        elif isinstance(nd, LatexCharsNode):
-            seg = tex[s:e]
-            for m in BLANKLINE_RE.finditer(seg):
-                allowed.add(s + m.end())
-        elif isinstance(nd, LatexMacroNode) and nd.macroname == "par":
-            allowed.add(e)
-        # 其它（宏、分组、数学等）都视为行内：不加入任何边界
-
-    cuts = sorted(p for p in allowed if body_start <= p <= body_end)
-    if not cuts or cuts[0] != body_start or cuts[-1] != body_end:
+    add(body_end)
+    if cuts[0] != body_start or cuts[-1] != body_end or \
+            any(b < a for a, b in zip(cuts, cuts[1:])):
         raise LaTeXSlicingError("合法切点集合异常")
     return cuts
 
 
-def latex_cut(tex: str, L: int, remove_comment: bool=True) -> Dict[str, Any]:
-    """
-    切分规则：
-      - 无 document：整篇为正文；有 document：正文为其内部。
-      - 只在：顶层环境边界、顶层空行、\\par 之后 切分；不会在任何行内宏/数学/分组边界处切。
-      - 每块长度 >= L；若总长 < L，则只返回 1 块。
-      - 贪心尽早切，但保证尾段也 >= L；若切点不足，则并入末段。
-    返回:
-      {"template": <正文替换为 $document 的模板>, "chunks": [块1, 块2, ...]}
-    """
+def _iter_chunks(tex_nc: str, cuts_allowed: List[int],
+                 body_start: int, body_end: int, L: int) -> Iterator[str]:
+    """惰性产出各块：贪心找第一个使当前块 >= L 的切点，并保证尾段也 >= L。
+    尾段兜底合并（最后一块 < L 时并入前一块）通过缓存最近两块实现，
+    因此峰值只持有 2 块，而不是整个块列表。"""
+
+    def raw() -> Iterator[str]:
+        cur = body_start
+        i = cuts_allowed.index(body_start)
+        last_idx = len(cuts_allowed) - 1
+
+        while i < last_idx:
+            # 第一个 >= cur+L 的切点（C 级二分，替代逐个线性扫描）
+            j = bisect.bisect_left(cuts_allowed, cur + L, i + 1)
+
+            if j > last_idx:
+                yield tex_nc[cur:body_end]
+                return
+
+            # 最后一个不破坏“尾段 >= L”的切点
+            k = bisect.bisect_right(cuts_allowed, body_end - L, j) - 1
+
+            if k < j:
+                yield tex_nc[cur:body_end]
+                return
+
+            cut_pos = cuts_allowed[j]
+            yield tex_nc[cur:cut_pos]
+            cur = cut_pos
+            i = j
+
+        if cur < body_end:
+            yield tex_nc[cur:body_end]
+
+    # 保障每块（尤其倒数第二块）≥ L；若尾段 < L，则与前一块合并兜底
+    pending: List[str] = []
+    for chunk in raw():
+        pending.append(chunk)
+        if len(pending) > 2:
+            yield pending.pop(0)
+    if len(pending) == 2 and len(pending[-1]) < L:
+        pending = [pending[0] + pending[1]]
+    yield from pending
+
+
+def _prepare_cut(tex: str, L: int, remove_comment: bool) -> Tuple[str, int, int, List[int]]:
+    """latex_cut / latex_cut_iter 的公共前置：校验、归一化、定位正文与切点。"""
     if not isinstance(tex, str):
         raise TypeError("tex 必须是 str")
     if not isinstance(L, int) or L <= 0:
@@ -208,61 +220,54 @@ def latex_cut(tex: str, L: int, remove_comment: bool=True) -> Dict[str, Any]:
     tex_nc = _remove_comments(tex) if remove_comment else tex
     tex_nc = remove_useless_newlines(tex_nc)
 
-    walker = LatexWalker(tex_nc)
-    root_nodes, _, _ = walker.get_latex_nodes()
-
-    body_start, body_end, doc_env = _document_body_bounds(tex_nc, root_nodes)
-    body_text = tex_nc[body_start:body_end]
-
-    if doc_env is not None:
-        body_nodes = list(doc_env.nodelist)
-    else:
-        body_nodes = root_nodes
-    body_nodes = [nd for nd in body_nodes if (nd.pos + nd.len) > body_start and nd.pos < body_end]
+    body_start, body_end = _document_body_bounds(tex_nc)
+    cuts_allowed = _allowed_cut_positions(tex_nc, body_start, body_end)
 
-    cuts_allowed = _allowed_cut_positions(tex_nc, body_start, body_end, body_nodes)
+    # 校准提示：切点过于稀疏（中位间距远大于 L）时，实际块长由切点间距决定，
+    # 而不是 L；提醒用户不要指望更小的 chunk_size 能奏效
+    if body_end - body_start > L and len(cuts_allowed) > 2:
+        median_gap = statistics.median(
+            b - a for a, b in zip(cuts_allowed, cuts_allowed[1:]))
+        if L < median_gap / 2:
+            print(f"[latex_cut] 警告：合法切点中位间距约 {int(median_gap)} 字符，"
+                  f"远大于 L={L}，实际块长将以切点间距为准")
 
-    total_len = body_end - body_start
-    if total_len <= L:
-        template = tex_nc[:body_start] + "$document" + tex_nc[body_end:]
-        return {"template": template, "chunks": [body_text]}
+    return tex_nc, body_start, body_end, cuts_allowed
 
-    chunks: List[str] = []
-    cur = body_start
-    i = cuts_allowed.index(body_start)
-    last_idx = len(cuts_allowed) - 1
 
-    while i < last_idx:
-        target = cur + L
-        j = i + 1
-        while j <= last_idx and cuts_allowed[j] < target:
-            j += 1
-
-        if j > last_idx:
-            chunks.append(tex_nc[cur:body_end])
-            break
-
-        k = j
-        while k <= last_idx and cuts_allowed[k] <= (body_end - L):
-            k += 1
-        k -= 1
+def latex_cut(tex: str, L: int, remove_comment: bool=True) -> Dict[str, Any]:
+    """
+    切分规则：
+      - 无 document：整篇为正文；有 document：正文为其内部。
+      - 只在：顶层环境边界、顶层空行、\\par 之后 切分；不会在任何行内宏/数学/分组边界处切。
+      - 每块长度 >= L；若总长 < L，则只返回 1 块。
+      - 贪心尽早切，但保证尾段也 >= L；若切点不足，则并入末段。
+    返回:
+      {"template": <正文替换为 $document 的模板>, "chunks": [块1, 块2, ...]}
+    """
+    template, chunk_iter = latex_cut_iter(tex, L, remove_comment=remove_comment)
+    return {"template": template, "chunks": list(chunk_iter)}
 
-        if k < j:
-            chunks.append(tex_nc[cur:body_end])
-            break
 
-        cut_pos = cuts_allowed[j]
-        chunks.append(tex_nc[cur:cut_pos])
-        cur = cut_pos
-        i = j
+def latex_cut_iter(tex: str, L: int, remove_comment: bool = True) -> Tuple[str, Iterator[str]]:
+    """latex_cut 的惰性版本：返回 (template, 块迭代器)。
+    下游可以边产块边翻译，不必先在内存里物化整个块列表。"""
+    tex_nc, body_start, body_end, cuts_allowed = _prepare_cut(tex, L, remove_comment)
+    template = tex_nc[:body_start] + "$document" + tex_nc[body_end:]
 
-    if cur < body_end:
-        chunks.append(tex_nc[cur:body_end])
+    if body_end - body_start <= L:
+        return template, iter([tex_nc[body_start:body_end]])
 
-    template = tex_nc[:body_start] + "$document" + tex_nc[body_end:]
+    return template, _iter_chunks(tex_nc, cuts_allowed, body_start, body_end, L)
 
-    # 保障每块（尤其倒数第二块）≥ L；若尾段 < L，则与前一块合并兜底
-    if len(chunks) > 1 and len(chunks[-1]) < L:
-        chunks[-2:] = [chunks[-2] + chunks[-1]]
 
-    return {"template": template, "chunks": chunks}
+def latex_cut_batch(texs: List[str], L: int, remove_comment: bool = True,
+                    workers: Optional[int] = None) -> List[Dict[str, Any]]:
+    """批量切分多篇文档。切分是 CPU 密集的纯 Python 代码，GIL 下多线程无益，
+    用进程池并行；结果按输入顺序返回，每项即对应文档的 latex_cut 返回值。"""
+    if not texs:
+        return []
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        return list(ex.map(
+            functools.partial(latex_cut, L=L, remove_comment=remove_comment),
+            texs))
@@ -1,59 +1,190 @@
+import asyncio
+import hashlib
 import json
+import random
+import re
+import time
+from pathlib import Path
 from google import genai
-from google.genai import types
+from google.genai import errors, types
 from pydantic import BaseModel
 from tqdm import tqdm
-from string import Template
 from texsplit import latex_cut
 
 
-grammar = """对于汉语的语法特点，翻译出地道的中文。避免长句、从句、嵌套句式。\
-如果碰到原文是这类句子，务必拆分以符合清晰、流畅的现代汉语风格。
+# 提示词即 prefill 成本：每次未命中缓存的请求都要为它付费，
+# 因此只保留互不重复的规则，原来重复的“避免长句”类表述已合并
+system_prompt = """你是专业译者，把用户给的 LaTeX 片段翻译成中文。规则：
+1. 译文是地道的现代汉语：不要翻译腔；长句、从句、被动句在不改变原义的前提下拆短改写。
+2. 保留全部 LaTeX 结构：公式原样不动，行内公式保留 `$`；label、index 等代码保持原样不翻译。
+3. 新出现的专业名词在译文后用括号注英文原文。
+输出一个 JSON 对象，仅含 latex 字段，值为译文本身；不要用 ``` 包裹，不要任何解释。
 """
 
-system_prompt = f"""你是一个专业的翻译家，擅长将 LaTeX 文档翻译成中文。请确保翻译准确，并保留 LaTeX 语法结构。
-用户会提供 LaTeX 文档的**片段**，你需要将这些片段翻译成通顺的中文。请注意以下几点：
+class Translation(BaseModel):
+   latex: str
 
-翻译成通顺的中文，不要有翻译腔，不要有长句、从句、被动句（碰到了要在不改变原义的前提下修改）。\
-保留原来所有的latex格式，不要修改公式。遇到新的特殊名词时，在括号里注上英文原文。\
-同时注意，不要翻译原文的label、index等代码相关的东西，保持原样。
 
-{grammar}
+class TranslationBatch(BaseModel):
+   items: list[Translation]
 
-你需要输出一个JSON对象，其中包含一个latex字段。其中直接输出翻译结果，不要有任何其他内容，例如用```包裹结果，或是任何其他解释性的内容。
 
-## Latex 格式
+def _latex_from_text(raw: str) -> str:
+   """后备解析：容忍模型偶发的 ``` 围栏，再做 json.loads"""
+   raw = raw.strip()
+   if raw.startswith('```'):
+      raw = raw.strip('`').removeprefix('json').strip()
+   return json.loads(raw)['latex']
 
-确保不改变原有的 LaTeX 语法结构。对于行内公式，确保你正确添加了美元符号 `$`。
-"""
+def _extract_latex(response) -> str:
+   """取单片段译文。SDK 已按 response_schema 解析过一次（response.parsed），
+   直接用解析好的对象，不再对同一份 JSON 二次 json.loads。"""
+   parsed = getattr(response, 'parsed', None)
+   if isinstance(parsed, Translation):
+      return parsed.latex
+   return _latex_from_text(response.candidates[0].content.parts[0].text)
 
-template = """$latex
------
-{{grammar}}
-"""
+def _extract_batch(response) -> list:
+   """取成组译文（TranslationBatch），返回中文列表"""
+   parsed = getattr(response, 'parsed', None)
+   if isinstance(parsed, TranslationBatch):
+      return [item.latex for item in parsed.items]
+   raw = response.candidates[0].content.parts[0].text
+   return [item['latex'] for item in json.loads(raw)['items']]
 
-class Translation(BaseModel):
-   latex: str
+
+# 估算“散文占比”用：行内公式与带参数的宏都不算散文
+_MARKUP_RE = re.compile(r'\$.*?\$|\\[a-zA-Z]+(?:\{[^}]*\})?')
+
+def _thinking_budget(chunk: str) -> int:
+   """按片段的散文密度选 thinking 预算：公式为主的片段几乎原样保留，
+   不值得花推理 token；散文越密，译文组织越需要斟酌。"""
+   if not chunk:
+      return 0
+   prose_ratio = len(_MARKUP_RE.sub('', chunk)) / len(chunk)
+   if prose_ratio < 0.2:
+      return 0
+   if prose_ratio < 0.6:
+      return 512
+   return 2048
+
+
+# 单次请求超时（毫秒）；长 chunk + thinking 也远在此之内
+_REQUEST_TIMEOUT_MS = 120_000
+# 值得重试的 HTTP 状态码：限流与服务端瞬时故障
+_RETRYABLE_CODES = frozenset((408, 429, 500, 502, 503, 504))
+
+def _is_retryable(exc) -> bool:
+   if isinstance(exc, errors.APIError):
+      return exc.code in _RETRYABLE_CODES
+   return isinstance(exc, (TimeoutError, ConnectionError))
+
+def _backoff(attempt: int, base_wait=1.0, max_wait=60.0) -> float:
+   """指数退避 + 随机抖动，避免多个 worker 同步重试"""
+   return min(max_wait, base_wait * 2 ** attempt) * (0.5 + random.random())
+
+def _retry(fn, attempts=6):
+   """瞬时故障（429/5xx/超时）自动重试；其余异常立即抛出。
+   长任务（几十个 chunk 的论文）不该因一次 503 前功尽弃。"""
+   for attempt in range(attempts):
+      try:
+         return fn()
+      except Exception as e:
+         if attempt == attempts - 1 or not _is_retryable(e):
+            raise
+         time.sleep(_backoff(attempt))
+
+async def _retry_async(fn, attempts=6):
+   """_retry 的异步版本（并发路径用 asyncio.sleep 退避，不阻塞事件循环）"""
+   for attempt in range(attempts):
+      try:
+         return await fn()
+      except Exception as e:
+         if attempt == attempts - 1 or not _is_retryable(e):
+            raise
+         await asyncio.sleep(_backoff(attempt))
+
+
+class TranslationCache:
+   """译文磁盘缓存。键由调用方给出（见 Translator._cache_key：system prompt、
+   模型、thinking 预算、片段内容的组合），任何会改变译文的输入变了都会失效；
+   重跑同一篇论文时未变的片段直接复用旧译文，不再请求 API。"""
+   def __init__(self, cache_dir='./.translate_cache'):
+      self.dir = Path(cache_dir)
+      self.dir.mkdir(parents=True, exist_ok=True)
+
+   def _path(self, key: str) -> Path:
+      digest = hashlib.blake2b(key.encode('utf-8')).hexdigest()
+      return self.dir / f"{digest}.json"
+
+   def get(self, key: str):
+      path = self._path(key)
+      if path.exists():
+         return json.loads(path.read_text(encoding='utf-8'))['chinese']
+      return None
+
+   def set(self, key: str, chinese: str):
+      self._path(key).write_text(
+         json.dumps({"chinese": chinese}, ensure_ascii=False), encoding='utf-8')
 
 
 class Translator:
-   def __init__(self, client, model="gemini-2.5-flash", history=None):
+   def __init__(self, client, model="gemini-2.5-flash", history=None, cache=None, context_cache=False, adaptive_thinking=True, partial_path=None, stream=False, service_tier="flex"):
       self.client = client
       self.model = model
-      if history is not None:
-         history = self.format_history(history)
-      self.chat = client.chats.create(
-                      model=self.model, 
-                      config=types.GenerateContentConfig(
-                        system_instruction=system_prompt,
+      self.cache = cache
+      # 可选的 few-shot 前缀：不再作为 chat 历史累积，而是随每次请求重发
+      self.history = self.format_history(history) if history is not None else None
+      # context_cache=True 时把 system prompt 放进服务端 CachedContent：命中部分
+      # 按一折计费，TTFT 更快。默认关闭：当前压缩后的提示词只有约 200 token，
+      # 低于 Gemini 的最低可缓存上下文（1024+），创建必然失败，白付一次往返；
+      # 只有配合长 few-shot 前缀等把固定内容撑过门槛时才值得打开
+      # 离线整篇翻译用 flex 档（半价、可被调度挪后）；交互场景可传 "priority"
+      self._config_base = dict(
                         response_mime_type="application/json",
                         response_schema=Translation,
+                        http_options=types.HttpOptions(timeout=_REQUEST_TIMEOUT_MS),
+                        service_tier=service_tier,
+                    )
+      self.cached_content = None
+      if context_cache:
+         try:
+            ctx = client.caches.create(
+                     model=model,
+                     config=types.CreateCachedContentConfig(
+                        system_instruction=system_prompt, ttl="3600s"))
+            self.cached_content = ctx.name
+         except errors.APIError as e:
+            # 只吞 API 层的拒绝（如内容低于最低缓存 token 数）；
+            # 认证/网络等其它异常照常抛出，别等到第一次翻译才暴露
+            print(f"[translator] 上下文缓存创建失败（{e.code}），"
+                  f"退回内联 system_instruction")
+      if self.cached_content is not None:
+         self._config_base['cached_content'] = self.cached_content
+      else:
+         self._config_base['system_instruction'] = system_prompt
+      self.adaptive_thinking = adaptive_thinking
+      self.stream = stream
+      self.config = types.GenerateContentConfig(
+                        **self._config_base,
                         thinking_config=types.ThinkingConfig(thinking_budget=1024)
-                      ),
-                      history=history
                     )
       self.translated = []
-      self.template = Template(template)
+      # 增量日志路径：每个完成的片段追加一行 jsonl，中断后可据此续传
+      self.partial_path = partial_path
+      # chinese 属性的缓存：只追加的列表 + 脏标记，避免每次访问都重新 join
+      self._chinese_buf = []
+      self._chinese_cache = ""
+      self._chinese_dirty = False
+
+   def _config_for(self, text: str) -> types.GenerateContentConfig:
+      """按片段复杂度选 thinking 预算；关闭自适应时复用固定配置"""
+      if not self.adaptive_thinking:
+         return self.config
+      return types.GenerateContentConfig(
+                **self._config_base,
+                thinking_config=types.ThinkingConfig(
+                   thinking_budget=_thinking_budget(text)))
    
    @staticmethod
    def format_history(h):
@@ -69,25 +200,130 @@ class Translator:
 
       return history
 
+   def _cache_key(self, text: str) -> str:
+      """缓存键：影响译文的全部输入（提示词、模型、thinking 预算、片段）"""
+      budget = _thinking_budget(text) if self.adaptive_thinking else 1024
+      return f"{system_prompt}\n{self.model}\n{budget}\n{text}"
+
+   def _contents(self, message: str):
+      """拼接请求内容：few-shot 前缀（若有）+ 当前片段"""
+      if self.history:
+         return self.history + [message]
+      return message
+
    def append(self, eng: str, ch: str):
-      """将翻译结果添加到已翻译列表中"""
+      """将翻译结果添加到已翻译列表中，并追加写入增量日志（若配置了）"""
       self.translated.append({
            "english": eng,
            "chinese": ch
       })
+      self._chinese_buf.append(ch)
+      self._chinese_dirty = True
+      if self.partial_path is not None:
+         with open(self.partial_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({"english": eng, "chinese": ch},
+                               ensure_ascii=False) + "\n")
  
    def translate(self, text: str) -> str:
-      """将 LaTeX 文档片段翻译成中文"""
-      message = self.template.substitute(latex=text)
-      response = self.chat.send_message(message)
-      text_chinese = json.loads(response.candidates[0].content.parts[0].text)['latex']
+      """将 LaTeX 文档片段翻译成中文。缓存命中时返回 None（无 API 响应）"""
+      if self.cache is not None:
+         cached = self.cache.get(self._cache_key(text))
+         if cached is not None:
+            self.append(eng=text, ch=cached)
+            return None
+      # 消息就是片段本身：语法规则只在 system_prompt 里，无需模板替换
+      if self.stream:
+         response, text_chinese = _retry(lambda: self._generate_stream(text))
+      else:
+         response = _retry(lambda: self.client.models.generate_content(
+                        model=self.model,
+                        contents=self._contents(text),
+                        config=self._config_for(text)))
+         text_chinese = _extract_latex(response)
+      if self.cache is not None:
+         self.cache.set(self._cache_key(text), text_chinese)
       self.append(eng=text, ch=text_chinese)
       return response
+
+   def _generate_stream(self, text: str):
+      """流式生成：token 一到就累积，TTFT 更早（配合缓存的 prefill 尤甚），
+      网络接收与本地等待重叠。流式事件没有 parsed 字段，结束后整体解析一次。
+      返回 (最后一个事件, 中文)；最后的事件带完整的 usage_metadata。"""
+      pieces = []
+      last = None
+      for event in self.client.models.generate_content_stream(
+                      model=self.model,
+                      contents=self._contents(text),
+                      config=self._config_for(text)):
+         if event.text:
+            pieces.append(event.text)
+         last = event
+      return last, _latex_from_text(''.join(pieces))
+
+   def translate_group(self, texts: list) -> object:
+      """把一组片段打包进一次请求翻译，摊薄每请求的固定开销（RTT、prefill 预热）。
+      结果按原顺序 append；缓存命中的片段不随组发送。整组命中时返回 None。"""
+      results = [None] * len(texts)
+      misses = list(range(len(texts)))
+      if self.cache is not None:
+         misses = []
+         for i, t in enumerate(texts):
+            cached = self.cache.get(self._cache_key(t))
+            if cached is not None:
+               results[i] = cached
+            else:
+               misses.append(i)
+
+      response = None
+      if misses:
+         payload = json.dumps([texts[i] for i in misses], ensure_ascii=False)
+         message = ("以下 JSON 数组包含多个 LaTeX 片段。请逐个翻译，"
+                    "并按原顺序在 items 中输出对应译文：\n" + payload)
+         cfg_kwargs = dict(self._config_base, response_schema=TranslationBatch)
+         budget = (max(_thinking_budget(texts[i]) for i in misses)
+                   if self.adaptive_thinking else 1024)
+         config = types.GenerateContentConfig(
+                     **cfg_kwargs,
+                     thinking_config=types.ThinkingConfig(thinking_budget=budget))
+         response = _retry(lambda: self.client.models.generate_content(
+                        model=self.model,
+                        contents=self._contents(message),
+                        config=config))
+         items = _extract_batch(response)
+         if len(items) != len(misses):
+            raise ValueError(f"组内片段数不符：发送 {len(misses)}，收到 {len(items)}")
+         for i, item in zip(misses, items):
+            results[i] = item
+            if self.cache is not None:
+               self.cache.set(self._cache_key(texts[i]), results[i])
+
+      for t, ch in zip(texts, results):
+         self.append(eng=t, ch=ch)
+      return response
+
+   async def translate_async(self, text: str):
+      """异步翻译单个片段（并发路径）。
+      返回 (response, 中文文本)，由调用方按原顺序 append。"""
+      if self.cache is not None:
+         cached = self.cache.get(self._cache_key(text))
+         if cached is not None:
+            return None, cached
+      response = await _retry_async(lambda: self.client.aio.models.generate_content(
+                     model=self.model,
+                     contents=self._contents(text),
+                     config=self._config_for(text)))
+      text_chinese = _extract_latex(response)
+      if self.cache is not None:
+         self.cache.set(self._cache_key(text), text_chinese)
+      return response, text_chinese
  
    @property
    def chinese(self) -> str:
-      """获取所有翻译结果的中文文本"""
-      return "\n".join([item['chinese'] for item in self.translated])
+      """获取所有翻译结果的中文文本（缓存上次 join 的结果，脏了才重拼）"""
+      if self._chinese_dirty:
+         self._chinese_cache = "\n".join(self._chinese_buf)
+         self._chinese_dirty = False
+      return self._chinese_cache
 
 
 def create_report(total_prompt, cached, reasoning, output):
@@ -108,10 +344,19 @@ def parse_usage(res):
    return create_report(total_prompt, cached, reasoning, output)
 
 class LaTeXTranslator:
-   def __init__(self, client, model="gemini-2.5-flash", chunk_size=3000, save_path='./translated.text', history=None):
-      self.translator = Translator(client, model, history=history)
+   def __init__(self, client, model="gemini-2.5-flash", chunk_size=3000, save_path='./translated.text', history=None, concurrency=1, cache_dir='./.translate_cache', mode='interactive', group_size=1, save_every=10, target_tokens=None, service_tier='flex'):
+      cache = TranslationCache(cache_dir) if cache_dir is not None else None
+      self.partial_path = save_path + '.partial.jsonl'
+      self.translator = Translator(client, model, history=history, cache=cache,
+                                   partial_path=self.partial_path,
+                                   service_tier=service_tier)
       self.chunk_size = chunk_size
       self.save_path = save_path
+      self.concurrency = concurrency
+      self.mode = mode
+      self.group_size = group_size
+      self.save_every = save_every
+      self.target_tokens = target_tokens
    
    @property
    def translated(self) -> str:
@@ -123,16 +368,158 @@ class LaTeXTranslator:
       with open(self.save_path, 'w', encoding='utf-8') as f:
          f.write(self.translated)
    
+   def _load_partial(self) -> dict:
+      """读取上次中断留下的增量日志，返回 {英文片段: 中文}，用于断点续传"""
+      done = {}
+      path = Path(self.partial_path)
+      if path.exists():
+         for line in path.read_text(encoding='utf-8').splitlines():
+            if line.strip():
+               item = json.loads(line)
+               done[item['english']] = item['chinese']
+      return done
+
+   def _chunk_size_for(self, latex: str) -> int:
+      """把 target_tokens 换算成字符数的 chunk_size。字符/token 比随内容变化
+      （CJK、公式密度），固定字符数可能离目标 token 预算很远；用整篇的实际
+      token 数求平均密度再换算，每个请求都落在模型高效的 prefill 区间附近。"""
+      counted = self.translator.client.models.count_tokens(
+                   model=self.translator.model, contents=latex)
+      if not counted.total_tokens:
+         return self.chunk_size
+      chars_per_token = len(latex) / counted.total_tokens
+      return max(1, int(self.target_tokens * chars_per_token))
+
    def translate(self, latex: str, max_n:int=None) -> str:
-      latex_chunks = latex_cut(latex, self.chunk_size)
+      chunk_size = self.chunk_size
+      if self.target_tokens is not None:
+         chunk_size = self._chunk_size_for(latex)
+      latex_chunks = latex_cut(latex, chunk_size)
       self.template, self.chunks = latex_chunks['template'], latex_chunks['chunks']
 
       if max_n is not None:
          self.chunks = self.chunks[:max_n]
 
+      if self.mode == 'batch':
+         self._translate_batch()
+      elif self.group_size > 1:
+         self._translate_grouped()
+      elif self.concurrency > 1:
+         asyncio.run(self._translate_concurrent())
+      else:
+         self._translate_sequential()
+
+      # 全部完成：最终落盘，并清掉断点续传日志
+      self.save()
+      Path(self.partial_path).unlink(missing_ok=True)
+
+   @staticmethod
+   def _dedup_key(chunk: str) -> str:
+      """片段去重键：空白归一化，连仅缩进/换行不同的重复模板也能命中"""
+      return ' '.join(chunk.split())
+
+   def _translate_sequential(self):
+      resume = self._load_partial()
+      seen = {}   # 去重键 -> 中文：同一内容的片段整篇只翻译一次
       pbar = tqdm(self.chunks, desc="Translating")
-      for chunk in pbar:
-         response = self.translator.translate(chunk)
-         usage_info = parse_usage(response)
-         pbar.set_postfix_str(usage_info)
-         self.save()
\ No newline at end of file
+      for i, chunk in enumerate(pbar):
+         key = self._dedup_key(chunk)
+         if chunk in resume:
+            self.translator.append(eng=chunk, ch=resume[chunk])
+            seen.setdefault(key, resume[chunk])
+         elif key in seen:
+            self.translator.append(eng=chunk, ch=seen[key])
+         else:
+            response = self.translator.translate(chunk)
+            if response is not None:
+               pbar.set_postfix_str(parse_usage(response))
+            seen[key] = self.translator.translated[-1]['chinese']
+         # 整篇重写输出文件是 O(总长) 的：每 save_every 个片段才落一次盘，
+         # 片段级的持久化由 append() 的增量日志负责
+         if (i + 1) % self.save_every == 0:
+            self.save()
+
+   def _translate_grouped(self):
+      """把相邻片段按 group_size 打包，每组一次请求，降低 RTT 占比"""
+      groups = [self.chunks[i:i + self.group_size]
+                for i in range(0, len(self.chunks), self.group_size)]
+      pbar = tqdm(groups, desc="Translating")
+      for i, group in enumerate(pbar):
+         response = self.translator.translate_group(group)
+         if response is not None:
+            pbar.set_postfix_str(parse_usage(response))
+         if (i + 1) % self.save_every == 0:
+            self.save()
+
+   def _translate_batch(self, poll_interval=30):
+      """Batch 模式：整篇提交给 Gemini Batch API，半价计费，并发由服务端调度。
+      非交互场景（整篇论文离线翻译）可容忍分钟到小时级的排队延迟。"""
+      translator = self.translator
+      # 缓存命中的片段不提交，只为未命中的片段建请求
+      pending = []   # [(片段在 self.chunks 中的下标, 片段)]
+      results = {}   # 下标 -> 中文
+      for idx, chunk in enumerate(self.chunks):
+         if translator.cache is not None:
+            cached = translator.cache.get(translator._cache_key(chunk))
+            if cached is not None:
+               results[idx] = cached
+               continue
+         pending.append((idx, chunk))
+
+      if pending:
+         requests = [{
+               "contents": [types.Content(
+                  role="user",
+                  parts=[types.Part(text=chunk)])],
+               "config": translator._config_for(chunk),
+            } for _, chunk in pending]
+         job = translator.client.batches.create(
+                  model=translator.model,
+                  src={'inlined_requests': requests})
+
+         print(f"[batch] 已提交 {len(pending)} 个片段，任务 {job.name}，等待完成……")
+         done_states = {'JOB_STATE_SUCCEEDED', 'JOB_STATE_FAILED', 'JOB_STATE_CANCELLED'}
+         while job.state.name not in done_states:
+            time.sleep(poll_interval)
+            job = translator.client.batches.get(name=job.name)
+         if job.state.name != 'JOB_STATE_SUCCEEDED':
+            raise RuntimeError(f"Batch 任务未成功：{job.state.name}")
+
+         for (idx, chunk), inline in zip(pending, job.dest.inlined_responses):
+            text_chinese = _extract_latex(inline.response)
+            if translator.cache is not None:
+               translator.cache.set(translator._cache_key(chunk), text_chinese)
+            results[idx] = text_chinese
+
+      for idx, chunk in enumerate(self.chunks):
+         translator.append(eng=chunk, ch=results[idx])
+
+   async def _translate_concurrent(self):
+      """并发翻译所有片段：Semaphore 限流，gather 保证结果按原顺序回填。
+      重复片段只发一次请求，结果按去重键广播回每个出现位置。"""
+      resume = self._load_partial()
+      sem = asyncio.Semaphore(self.concurrency)
+
+      keys = [self._dedup_key(chunk) for chunk in self.chunks]
+      unique = {}   # 去重键 -> 首次出现的片段
+      for key, chunk in zip(keys, self.chunks):
+         unique.setdefault(key, chunk)
+
+      pbar = tqdm(total=len(unique), desc="Translating")
+
+      async def worker(chunk):
+         if chunk in resume:
+            pbar.update(1)
+            return resume[chunk]
+         async with sem:
+            response, text_chinese = await self.translator.translate_async(chunk)
+            if response is not None:
+               pbar.set_postfix_str(parse_usage(response))
+            pbar.update(1)
+            return text_chinese
+
+      results = await asyncio.gather(*[worker(chunk) for chunk in unique.values()])
+      pbar.close()
+      by_key = dict(zip(unique, results))
+      for chunk, key in zip(self.chunks, keys):
+         self.translator.append(eng=chunk, ch=by_key[key])
\ No newline at end of file